@@ -4,13 +4,49 @@ import asyncio
 import dataclasses
 import logging
 import struct
+import sys
 from enum import Enum
+from typing import NamedTuple
 
 from bleak import BLEDevice, BleakClient, BleakGATTCharacteristic
-from bleak_retry_connector import establish_connection
 
 from .const import CHAR_UUID_HEATER_CONTROL
 
+_LOGGER = logging.getLogger(__name__)
+
+# Seconds to wait for the heater to respond to a command
+_RESPONSE_TIMEOUT = 10.0
+
+# Slots are only supported by dataclasses since Python 3.10
+_DATACLASS_OPTIONS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+# Consecutive valid status packets after which only their checksum is verified
+_TRUSTED_PACKET_THRESHOLD = 32
+
+_STATUS_STRUCT = struct.Struct("<HBBBBHBBBHHHBxB")
+_COMMAND_STRUCT = struct.Struct("<8B")
+
+_CMD_STATUS = bytes([0xAA, 0x55, 0x0C, 0x22, 0x01, 0x00, 0x00, 0x2F])
+_CMD_ON = bytes([0xAA, 0x55, 0x0C, 0x22, 0x03, 0x01, 0x00, 0x32])
+_CMD_OFF = bytes([0xAA, 0x55, 0x0C, 0x22, 0x03, 0x00, 0x00, 0x31])
+# Checksum contribution of the passkey and request type bytes of the parametrized commands
+_PREFIX_MODE_SUM = 0x0C + 0x22 + 0x02
+_PREFIX_TARGET_SUM = 0x0C + 0x22 + 0x04
+
+
+def _bitmask(values) -> int:
+    return sum(1 << value for value in values)
+
+
+# Allowed values of the status fields, as bitmasks indexed by the field value
+_POWER_STATUS_MASK = _bitmask(range(3))
+_ERROR_MASK = _bitmask(range(11))
+_OPERATIONAL_STATUS_MASK = _bitmask(range(5))
+_OPERATIONAL_MODE_MASK = _bitmask(range(3))
+_CURRENT_POWER_LEVEL_MASK = _bitmask(range(10))
+# Allowed target power levels / temperatures, indexed by the operational mode
+_TARGET_MASKS = (_bitmask(range(1)), _bitmask(range(1, 11)), _bitmask(range(8, 37)))
+
 
 class RequestType(Enum):
     READ_STATUS = 1
@@ -25,6 +61,9 @@ class PowerStatus(Enum):
     ERROR = 2
 
 
+_POWER_STATUS_BY_VALUE = {member.value: member for member in PowerStatus}
+
+
 class OperationalStatus(Enum):
     WARMUP = 0
     SELF_TEST_RUNNING = 1
@@ -33,11 +72,17 @@ class OperationalStatus(Enum):
     SHUTTING_DOWN = 4
 
 
+_OPERATIONAL_STATUS_BY_VALUE = {member.value: member for member in OperationalStatus}
+
+
 class OperationalMode(Enum):
     POWER_LEVEL = 1
     TARGET_TEMPERATURE = 2
 
 
+_OPERATIONAL_MODE_BY_VALUE = {member.value: member for member in OperationalMode}
+
+
 class HeaterError(Enum):
     NO_ERROR = 0
     POWER_SUPPLY_UNDERVOLTAGE = 1
@@ -52,7 +97,10 @@ class HeaterError(Enum):
     IGNITION_FAILURE = 10
 
 
-@dataclasses.dataclass
+_HEATER_ERROR_BY_VALUE = {member.value: member for member in HeaterError}
+
+
+@dataclasses.dataclass(**_DATACLASS_OPTIONS)
 class VevorHeaterStatus(object):
     power_status: PowerStatus = None
     operational_mode: OperationalMode = None
@@ -71,30 +119,29 @@ class VevorHeaterStatus(object):
         if not status_ble.power_status:
             return VevorHeaterStatus(power_status=PowerStatus.OFF)
 
-        opmode = OperationalMode(status_ble.operational_mode) if status_ble.operational_mode else None
+        opmode = _OPERATIONAL_MODE_BY_VALUE[status_ble.operational_mode] if status_ble.operational_mode else None
         target_temp_or_level = status_ble.target_temperature_or_level
-        if OperationalMode == OperationalMode.TARGET_TEMPERATURE:
+        if opmode is OperationalMode.TARGET_TEMPERATURE:
             current_power_level = status_ble.current_power_level + 1
         else:
             current_power_level = target_temp_or_level
 
         return VevorHeaterStatus(
-            power_status=PowerStatus(status_ble.power_status),
+            power_status=_POWER_STATUS_BY_VALUE[status_ble.power_status],
             operational_mode=opmode,
-            operational_status=OperationalStatus(status_ble.operational_status),
+            operational_status=_OPERATIONAL_STATUS_BY_VALUE[status_ble.operational_status],
             elevation=float(status_ble.elevation),
-            target_temperature=target_temp_or_level if opmode == OperationalMode.TARGET_TEMPERATURE else None,
-            target_power_level=target_temp_or_level if opmode == OperationalMode.POWER_LEVEL else None,
+            target_temperature=target_temp_or_level if opmode is OperationalMode.TARGET_TEMPERATURE else None,
+            target_power_level=target_temp_or_level if opmode is OperationalMode.POWER_LEVEL else None,
             current_power_level=current_power_level,
             input_voltage=float(status_ble.input_voltage_decivolts) / 10,
             combustion_temperature=status_ble.combustion_temperature,
             room_temperature=status_ble.room_temperature,
-            error=HeaterError(status_ble.display_error) if status_ble.display_error else HeaterError.NO_ERROR,
+            error=_HEATER_ERROR_BY_VALUE[status_ble.display_error],
         )
 
 
-@dataclasses.dataclass
-class VevorHeaterStatusBle(object):
+class VevorHeaterStatusBle(NamedTuple):
     magic_constant: int = None
     request_type: int = None
     power_status: int = None
@@ -111,63 +158,52 @@ class VevorHeaterStatusBle(object):
     checksum: int = None
 
     @staticmethod
-    def from_ble_data_array(buffer: bytearray) -> VevorHeaterStatusBle | None:
-        unpack_format = "<HBBBBHBBBHHHBxB"
-        unpacked = struct.unpack(unpack_format, buffer)
-        result = VevorHeaterStatusBle(*unpacked)
-        if result._verify():
+    def from_ble_data_array(
+            buffer: bytes | bytearray | memoryview, full_verification: bool = True) -> VevorHeaterStatusBle | None:
+        data = memoryview(buffer)
+        if data.nbytes != _STATUS_STRUCT.size:
+            _LOGGER.warning("Unable to parse %d bytes as heater status!", data.nbytes)
+            return None
+        unpacked = _STATUS_STRUCT.unpack_from(data)
+        result = VevorHeaterStatusBle._make(unpacked)
+        if result._verify(data, full_verification):
             return result
         else:
-            logging.warning("Unable to parse " + str(unpacked) + " as heater status!")
+            _LOGGER.warning("Unable to parse %s as heater status!", unpacked)
             return None
 
-    def _verify(self) -> bool:
-        self._verification_errors = []
-
-        if self.power_status != 0:
-            if self.request_type <= 0 not in range(1, 5):
-                self._verification_errors.append("request_type")
-            if self.power_status not in (0, 1, 2):
-                self._verification_errors.append("power_status")
-            if self.error not in range(11):
-                self._verification_errors.append("error")
-            if self.operational_status not in range(5):
-                self._verification_errors.append("operational_status")
-            if self.operational_mode not in (0, 1, 2):
-                self._verification_errors.append("operational_mode")
-            else:
-                if self.operational_mode == 1:
-                    allowed_target_range = range(1, 11)
-                elif self.operational_mode == 2:
-                    allowed_target_range = range(8, 37)
-                else:
-                    allowed_target_range = range(1)
-                if self.target_temperature_or_level not in allowed_target_range:
-                    self._verification_errors.append("target_temperature_or_level")
-            if self.operational_mode == 2 and self.current_power_level not in range(10):
-                self._verification_errors.append("current_power_level")
-            if self.display_error not in range(11):
-                self._verification_errors.append("display_error")
-
-        calculated_checksum = sum((
-            self.power_status,
-            self.error,
-            self.operational_status,
-            self.elevation,
-            self.operational_mode,
-            self.target_temperature_or_level,
-            self.current_power_level,
-            self.input_voltage_decivolts,
-            self.combustion_temperature,
-            self.room_temperature,
-            self.display_error)) % 256
-        if calculated_checksum != self.checksum:
-            self._verification_errors.append("checksum")
-
-        if self._verification_errors:
-            logging.warning(str(self) + " has verification errors: " + str(self._verification_errors))
-
-        return not bool(self._verification_errors)
+    def _verify(self, data: memoryview, full_verification: bool = True) -> bool:
+        (_, request_type, power_status, error, operational_status, _, operational_mode, target_temperature_or_level,
+         current_power_level, _, _, _, display_error, checksum) = self
+        verification_errors = []
+
+        if full_verification and power_status != 0:
+            if not 1 <= request_type <= 4:
+                verification_errors.append("request_type")
+            if not (_POWER_STATUS_MASK >> power_status) & 1:
+                verification_errors.append("power_status")
+            if not (_ERROR_MASK >> error) & 1:
+                verification_errors.append("error")
+            if not (_OPERATIONAL_STATUS_MASK >> operational_status) & 1:
+                verification_errors.append("operational_status")
+            if not (_OPERATIONAL_MODE_MASK >> operational_mode) & 1:
+                verification_errors.append("operational_mode")
+            elif not (_TARGET_MASKS[operational_mode] >> target_temperature_or_level) & 1:
+                verification_errors.append("target_temperature_or_level")
+            if operational_mode == 2 and not (_CURRENT_POWER_LEVEL_MASK >> current_power_level) & 1:
+                verification_errors.append("current_power_level")
+            if not (_ERROR_MASK >> display_error) & 1:
+                verification_errors.append("display_error")
+
+        # The checksum covers the raw bytes from the power status up to the checksum itself
+        calculated_checksum = sum(data[3:_STATUS_STRUCT.size - 1]) & 0xFF
+        if calculated_checksum != checksum:
+            verification_errors.append("checksum")
+
+        if verification_errors:
+            _LOGGER.warning("%s has verification errors: %s", self, verification_errors)
+
+        return not bool(verification_errors)
 
 
 class VevorDevice:
@@ -176,67 +212,179 @@ class VevorDevice:
         self.address = address
         self.status = status
         self.command_lock = asyncio.Lock()
+        self._client: BleakClient | None = None
+        self._pending: dict[int, asyncio.Future] = {}
+        self._trust = 0
+        self._tx_queue: asyncio.Queue[tuple[BLEDevice, bytes, asyncio.Future]] | None = None
+        self._worker: asyncio.Task | None = None
 
     def __str__(self):
         return f"VevorDevice(name={self.name}, address={self.address}, status={self.status})"
 
-    async def _send_ble_command(self, device: BLEDevice, data: bytearray) -> VevorHeaterStatus | None:
+    async def close(self):
+        # Detach both before awaiting, so commands sent meanwhile start a new worker on a new queue
+        worker, self._worker = self._worker, None
+        tx_queue, self._tx_queue = self._tx_queue, None
+        if worker is not None:
+            worker.cancel()
+            # Wait for the in-flight command to unwind and release command_lock. Unlike suppressing
+            # CancelledError around "await worker", this still propagates a cancellation of close() itself.
+            await asyncio.gather(worker, return_exceptions=True)
+        while tx_queue is not None and not tx_queue.empty():
+            _, _, result = tx_queue.get_nowait()
+            # Like on a disconnect, the command completes without a status rather than cancelling its caller
+            if not result.done():
+                result.set_result(None)
+        await self._disconnect()
+
+    async def _disconnect(self):
+        client, self._client = self._client, None
+        if client is not None:
+            await client.disconnect()
+
+    async def _connect(self, device: BLEDevice) -> BleakClient:
+        if self._client is not None and self._client.is_connected:
+            return self._client
+
+        # Imported lazily, as its dependency chain is only needed once a command is actually sent
+        from bleak_retry_connector import establish_connection
+
+        client = await establish_connection(
+            client_class=BleakClient,
+            device=device,
+            name=device.address,
+            disconnected_callback=self._on_disconnect,
+        )
+        try:
+            await client.start_notify(CHAR_UUID_HEATER_CONTROL, self._notification_handler)
+        except BaseException:
+            # Also on cancellation, as the client isn't stored anywhere yet
+            await client.disconnect()
+            raise
+        self._client = client
+        self._trust = 0
+        return client
+
+    def _on_disconnect(self, client: BleakClient):
+        if client is not self._client:
+            # A stale client, the pending commands belong to the current one
+            return
+        self._client = None
+        # Don't leave pending commands waiting for responses that will never arrive
+        for future in self._pending.values():
+            if not future.done():
+                future.set_result(None)
+        self._pending.clear()
+
+    def _notification_handler(self, _: BleakGATTCharacteristic, response_data: bytearray):
+        # Once the link has proven reliable, skip the range checks and rely on the checksum alone
+        status = VevorHeaterStatusBle.from_ble_data_array(
+            response_data, full_verification=self._trust <= _TRUSTED_PACKET_THRESHOLD)
+        try:
+            response = VevorHeaterStatus.from_ble_status(status) if status is not None else None
+        except KeyError:
+            # A packet which was only checksum-verified, with a value (including a non-zero
+            # operational mode) that doesn't map to a status enum member
+            response = None
+        if response is None:
+            self._trust = 0
+            _LOGGER.warning("Received invalid Vevor BLE response, discarding...")
+            self._discard_pending()
+            return
+        if self._trust <= _TRUSTED_PACKET_THRESHOLD:
+            self._trust += 1
+
+        future = self._pending.pop(status.request_type, None)
+        if future is None:
+            _LOGGER.warning("Received a response for a different request, discarding...")
+            self._discard_pending()
+        elif not future.done():
+            future.set_result(response)
+
+    def _discard_pending(self):
+        # Commands are sent one at a time, so an unusable response can only be the pending command's
+        if len(self._pending) == 1:
+            _, future = self._pending.popitem()
+            if not future.done():
+                future.set_result(None)
+
+    async def _enqueue(self, device: BLEDevice, data: bytes) -> VevorHeaterStatus | None:
         if device.address != self.address:
             raise ValueError("BLE addresses don't match!")
+        loop = asyncio.get_running_loop()
+        # Created here rather than in __init__, as before Python 3.10 queues bind to the current event loop
+        if self._tx_queue is None:
+            self._tx_queue = asyncio.Queue()
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._process_commands(self._tx_queue))
+        result = loop.create_future()
+        self._tx_queue.put_nowait((device, data, result))
+        return await result
+
+    async def _process_commands(self, tx_queue: asyncio.Queue):
+        while True:
+            device, data, result = await tx_queue.get()
+            if result.done():
+                # The caller stopped waiting before the command was sent
+                continue
+            try:
+                response = await self._send_ble_command(device, data)
+            except asyncio.CancelledError:
+                # The worker is stopped by close(), the caller itself wasn't cancelled
+                if not result.done():
+                    result.set_result(None)
+                raise
+            except Exception as e:
+                if not result.done():
+                    result.set_exception(e)
+            else:
+                if not result.done():
+                    result.set_result(response)
+
+    async def _send_ble_command(self, device: BLEDevice, data: bytes) -> VevorHeaterStatus | None:
         async with self.command_lock:
-            client = await establish_connection(client_class=BleakClient, device=device, name=device.address)
+            client = await self._connect(device)
+            request_type = data[4]
+            response = asyncio.get_running_loop().create_future()
+            self._pending[request_type] = response
             try:
-                response_received_latch = asyncio.Event()
-                response = None
-
-                def notification_handler(_: BleakGATTCharacteristic, response_data: bytearray):
-                    status = VevorHeaterStatusBle.from_ble_data_array(response_data)
-                    if status is None:
-                        logging.warning("Received invalid Vevor BLE response, discarding...")
-                    elif status.request_type != data[4]:
-                        logging.warning("Received a response for a different request, discarding...")
-                    else:
-                        nonlocal response
-                        response = VevorHeaterStatus.from_ble_status(status)
-
-                    response_received_latch.set()
-
-                await client.start_notify(CHAR_UUID_HEATER_CONTROL, notification_handler)
                 await client.write_gatt_char(CHAR_UUID_HEATER_CONTROL, data, response=True)
-                await response_received_latch.wait()
-                await client.stop_notify(CHAR_UUID_HEATER_CONTROL)
-                return response
+                return await asyncio.wait_for(response, _RESPONSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                _LOGGER.warning("Timed out waiting for a Vevor BLE response, discarding request...")
+                return None
+            except Exception:
+                await self._disconnect()
+                raise
             finally:
-                await client.disconnect()
+                self._pending.pop(request_type, None)
 
     async def _set_operational_mode(self, device: BLEDevice, mode: OperationalMode):
-        data = bytearray([0xAA, 0x55, 0x0C, 0x22, 0x02, mode.value, 0x00, 0x00])
-        checksum = sum(data[2:]) % 256
-        data[-1] = checksum
-        response = await self._send_ble_command(device, data)
+        checksum = (_PREFIX_MODE_SUM + mode.value) & 0xFF
+        data = _COMMAND_STRUCT.pack(0xAA, 0x55, 0x0C, 0x22, 0x02, mode.value, 0x00, checksum)
+        response = await self._enqueue(device, data)
         if response is not None:
             self.status = response
 
     async def _set_target(self, device: BLEDevice, target: int):
-        data = bytearray([0xAA, 0x55, 0x0C, 0x22, 0x04, target, 0x00, 0x00])
-        checksum = sum(data[2:]) % 256
-        data[-1] = checksum
-        response = await self._send_ble_command(device, data)
+        checksum = (_PREFIX_TARGET_SUM + target) & 0xFF
+        data = _COMMAND_STRUCT.pack(0xAA, 0x55, 0x0C, 0x22, 0x04, target, 0x00, checksum)
+        response = await self._enqueue(device, data)
         if response is not None:
             self.status = response
 
     async def refresh_status(self, device: BLEDevice):
-        response = await self._send_ble_command(device, bytearray([0xAA, 0x55, 0x0C, 0x22, 0x01, 0x00, 0x00, 0x2F]))
+        response = await self._enqueue(device, _CMD_STATUS)
         if response is not None:
             self.status = response
 
     async def turn_on(self, device: BLEDevice):
-        response = await self._send_ble_command(device, bytearray([0xAA, 0x55, 0x0C, 0x22, 0x03, 0x01, 0x00, 0x32]))
+        response = await self._enqueue(device, _CMD_ON)
         if response is not None:
             self.status = response
 
     async def turn_off(self, device: BLEDevice):
-        response = await self._send_ble_command(device, bytearray([0xAA, 0x55, 0x0C, 0x22, 0x03, 0x00, 0x00, 0x31]))
+        response = await self._enqueue(device, _CMD_OFF)
         if response is not None:
             self.status = response
 